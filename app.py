@@ -1,29 +1,72 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import os, base64, uuid, shutil, re, io, zipfile
+from flask import Flask, render_template, request, jsonify, send_file, Response
+import os, base64, uuid, shutil, re, io, zipfile, itertools, hashlib
 from PIL import Image
 import numpy as np
+from numba import njit
+import dlib
 import face_recognition
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 import pillow_heif
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None  # libturbojpeg not available, PIL decodes JPEGs instead
 import firebase_admin
 from firebase_admin import credentials, db
 from dotenv import load_dotenv
 import json
 import time
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+import tempfile
+import diskcache
+import threading
+import queue
 import warnings
 
 # MongoDB imports
 from pymongo import MongoClient
-import gridfs
+from bson.binary import Binary
 
 warnings.filterwarnings("ignore", category=UserWarning, module="face_recognition_models")
 
 # ========== ENV, FIREBASE and MONGODB SETUP ==================
 ref_encodings_cache = {}
-BATCH_SIZE = 30  # Tune this for performance vs memory
+PROGRESS_INTERVAL = 0.5  # Seconds between Firebase progress writes per app process
+MATCH_TOLERANCE = 0.6  # Max euclidean distance between encodings of the same person
+MAX_DETECTION_SIZE = 1024  # Long edge photos are shrunk to before face detection
+BATCH_SIZE = 32  # Images per CNN detector call on the GPU
+GPU_BATCH_WAIT = 0.05  # Seconds to wait for more images before running a partial batch
+# Images are staged here so workers get a path instead of pickled bytes. Set
+# STAGING_DIR=/dev/shm to stage in RAM, but only where /dev/shm is sized for
+# it (Docker gives containers 64 MB by default).
+STAGING_ROOT = os.getenv("STAGING_DIR", tempfile.gettempdir())
+DOWNLOAD_WORKERS = 16
+MAX_INFLIGHT_IMAGES = 32  # Staged images not yet consumed, bounds space used in STAGING_ROOT
+
+# Face encodings of Drive files keyed by file id and version, so re-running a folder
+# against another reference face only repeats the distance check. Evicted
+# oldest-first once the size cap is reached.
+enc_cache = diskcache.Cache(
+    os.getenv("ENCODING_CACHE_DIR", "/var/cache/veri-face/encs"),
+    size_limit=int(os.getenv("ENCODING_CACHE_SIZE", 512 * 1024 * 1024)),
+    eviction_policy="least-recently-stored",
+)
+# Finished result zips keyed by reference image + source files, so an
+# identical resubmission is served without rerunning the pipeline.
+zip_cache = diskcache.Cache(os.getenv("ZIP_CACHE_DIR", "/var/cache/veri-face/zips"))
+ZIP_CACHE_TTL = 3600
+FAILED_LIST_NAME = "failed_files.txt"  # Zip entry naming photos that could not be processed
+
+# Use dlib's CNN detector on the GPU when dlib was built with DLIB_USE_CUDA=1,
+# otherwise stay on the HOG detector which is far cheaper on CPU.
+USE_GPU = bool(dlib.DLIB_USE_CUDA) and dlib.cuda.get_num_devices() > 0
+FACE_DETECTION_MODEL = "cnn" if USE_GPU else "hog"
 
 load_dotenv() 
 token_info = json.loads(os.getenv("GOOGLE_TOKEN_JSON"))
@@ -37,7 +80,8 @@ firebase_admin.initialize_app(cred, {'databaseURL': url})
 MONGODB_URI = os.getenv("MONGODB_URI")
 mongo_client = MongoClient(MONGODB_URI)
 mongo_db = mongo_client['faceapp_db']  # You can name as needed
-fs = gridfs.GridFS(mongo_db)
+ref_encs = mongo_db['ref_encs']  # Reference face encodings, one document per session
+ref_encs.create_index("session_id", unique=True)
 
 def update_firebase_progress(session_id, current, total):
     try:
@@ -50,6 +94,31 @@ def update_firebase_progress(session_id, current, total):
     except Exception as e:
         print(f"Firebase update failed: {e}")
 
+# Progress updates waiting to be written, only the latest one per session
+_pending_progress = {}
+_progress_lock = threading.Lock()
+_progress_ready = threading.Event()
+
+def report_progress(session_id, current, total):
+    # Called once per image; the write to Firebase happens in the background
+    # at most every PROGRESS_INTERVAL seconds.
+    with _progress_lock:
+        _pending_progress[session_id] = (current, total)
+    _progress_ready.set()
+
+def progress_writer():
+    while True:
+        _progress_ready.wait()
+        _progress_ready.clear()
+        with _progress_lock:
+            pending = dict(_pending_progress)
+            _pending_progress.clear()
+        for session_id, (current, total) in pending.items():
+            update_firebase_progress(session_id, current, total)
+        time.sleep(PROGRESS_INTERVAL)
+
+threading.Thread(target=progress_writer, daemon=True).start()
+
 pillow_heif.register_heif_opener()
 
 app = Flask(__name__)
@@ -79,18 +148,98 @@ def check_google_drive_ready():
         print(f"❌ Google Drive not ready: {e}")
         return False
 
-def load_image_any_format(data):
+def check_dlib_build():
+    # The PyPI dlib sdist builds without AVX or a tuned BLAS, which makes the
+    # CPU encoding path several times slower. Refuse to serve in that state.
+    if not USE_GPU and not dlib.USE_AVX_INSTRUCTIONS:
+        print("❌ dlib was built without AVX instructions")
+        return False
+    if not (dlib.DLIB_USE_BLAS and dlib.DLIB_USE_LAPACK):
+        print("⚠️ dlib was built without BLAS/LAPACK, encodings will be slow")
+    print(f"✅ dlib ready (cuda={bool(dlib.DLIB_USE_CUDA)}, avx={bool(dlib.USE_AVX_INSTRUCTIONS)}, blas={bool(dlib.DLIB_USE_BLAS)})")
+    return True
+
+# Checked at import rather than under __main__ so gunicorn workers fail fast too
+if not check_dlib_build():
+    raise RuntimeError("dlib build is missing AVX support")
+
+def shrink_image(img, max_size):
+    if not max_size or max(img.shape[:2]) <= max_size:
+        return img
+    image = Image.fromarray(img)
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    return np.asarray(image)
+
+def decode_jpeg(data, max_size):
+    # Let libjpeg-turbo do most of the downscaling in the DCT domain, picking
+    # the smallest scale that keeps the long edge at or above max_size.
+    scaling_factor = None
+    if max_size:
+        width, height = turbo_jpeg.decode_header(data)[:2]
+        for num, den in ((1, 8), (1, 4), (1, 2)):
+            if max(width, height) * num // den >= max_size:
+                scaling_factor = (num, den)
+                break
+    return turbo_jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+
+def decode_heif(data):
+    heif_file = pillow_heif.read_heif(data, convert_hdr_to_8bit=True)
+    if heif_file.mode not in ("RGB", "RGBA"):
+        return None
+    return np.ascontiguousarray(np.asarray(heif_file)[..., :3])
+
+def load_image_any_format(data, max_size=None):
     try:
-        image = Image.open(data if isinstance(data, str) else io.BytesIO(data)).convert("RGB")
-        return np.array(image)
+        if isinstance(data, str):
+            with open(data, 'rb') as f:
+                data = f.read()
+        img = None
+        try:
+            if turbo_jpeg is not None and data[:3] == b'\xff\xd8\xff':
+                img = decode_jpeg(data, max_size)
+            elif pillow_heif.is_supported(data):
+                img = decode_heif(data)
+        except Exception as e:
+            print(f"Fast decode failed, falling back to PIL: {e}")
+        if img is None:
+            img = np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+        # Detection cost scales with pixel count while the encoder only
+        # sees a 150x150 face chip, so shrink large photos first.
+        return shrink_image(img, max_size)
     except Exception as e:
         print(f"❌ Image load error: {e}")
         return None
 
+# face_recognition keeps one module-level set of dlib models, shared by every
+# thread of a process (request threads, WORKER_POOL=thread, the GPU thread).
+# The models are not safe for concurrent forward passes if dlib releases the
+# GIL, so calls into them are serialized; running them in parallel would need
+# one model instance per thread.
+_dlib_lock = threading.Lock()
+
+def _reset_dlib_lock():
+    # Pool workers are forked on demand, possibly while a request thread is
+    # holding the lock; the child's copy would then never be released.
+    global _dlib_lock
+    _dlib_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_dlib_lock)
+
+def detect_face_encodings(img):
+    # Like extract_face_encodings, but lets detection errors propagate so
+    # they aren't mistaken for "no face"
+    with _dlib_lock:
+        if FACE_DETECTION_MODEL == "cnn":
+            locations = face_recognition.face_locations(img, number_of_times_to_upsample=0, model="cnn")
+        else:
+            locations = face_recognition.face_locations(img)
+        if not locations:
+            return []
+        return face_recognition.face_encodings(img, locations)
+
 def extract_face_encodings(img):
     try:
-        locations = face_recognition.face_locations(img)
-        return face_recognition.face_encodings(img, locations)
+        return detect_face_encodings(img)
     except:
         return []
 
@@ -105,133 +254,574 @@ def get_drive_service():
     creds = Credentials.from_authorized_user_info(token_info, scopes=['https://www.googleapis.com/auth/drive.readonly'])
     return build('drive', 'v3', credentials=creds)
 
+_thread_local = threading.local()
+
+def get_thread_drive_service():
+    # googleapiclient service objects are not thread-safe, keep one per thread
+    service = getattr(_thread_local, "drive_service", None)
+    if service is None:
+        service = _thread_local.drive_service = get_drive_service()
+    return service
+
+def download_drive_file(file_id, img_path):
+    request = get_thread_drive_service().files().get_media(fileId=file_id)
+    with open(img_path, 'wb') as fh:
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+
+def encoding_cache_key(file):
+    # Drive keeps a file's id when its content is replaced, so add the version
+    return f"{file['id']}:{file.get('md5Checksum') or file.get('modifiedTime', '')}"
+
 def download_drive_images(folder_id):
     service = get_drive_service()
     query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false"
-    result = service.files().list(q=query, fields="files(id, name)").execute()
+    result = service.files().list(q=query, fields="files(id, name, md5Checksum, modifiedTime)").execute()
     return result.get('files', [])
 
+def quantize_encodings(enc_arr, scale):
+    return np.clip(np.round(enc_arr * scale), -127, 127).astype(np.int8)
+
+def squared_norms(enc_q):
+    # Widen to int32 first since 128 products of int8 values overflow int16
+    enc_w = enc_q.astype(np.int32)
+    return np.einsum('ij,ij->i', enc_w, enc_w)
+
+@njit(cache=True)
+def any_match(enc_q, ref_q, ref_sq, thr2):
+    # True as soon as any probe is within sqrt(thr2) of any reference, using
+    # |a|^2 + |b|^2 - 2a.b in integer arithmetic on the int8 encodings.
+    for i in range(enc_q.shape[0]):
+        enc_sq = 0
+        for k in range(enc_q.shape[1]):
+            enc_sq += enc_q[i, k] * enc_q[i, k]
+        for j in range(ref_q.shape[0]):
+            dot = 0
+            for k in range(enc_q.shape[1]):
+                dot += enc_q[i, k] * ref_q[j, k]
+            if enc_sq + ref_sq[j] - 2 * dot < thr2:
+                return True
+    return False
+
+def _worker_init():
+    # Run the detector, the encoder and the match kernel once so each process
+    # has the dlib models loaded and numba code compiled before its first
+    # real task.
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    extract_face_encodings(blank)
+    with _dlib_lock:
+        enc = face_recognition.face_encodings(blank, [(0, 64, 64, 0)])
+    enc_q = quantize_encodings(np.asarray(enc, dtype=np.float32), 127)
+    any_match(enc_q, enc_q, squared_norms(enc_q), 0.0)
+
+# Warm up the app process too: it encodes reference images, and pool workers
+# forked from it start with the models already mapped.
+_worker_init()
+
+# Created once per app process and reused by every request. With a GPU this
+# pool only decodes images; detection and encoding run in batches on a single
+# GPU thread (see gpu_batch_loop) rather than in a process pool whose children
+# would all fight over the device. On CPU, WORKER_POOL=thread runs matching
+# in-process; it only overlaps decoding and I/O, since every dlib call holds
+# _dlib_lock and no two encodings ever run at once. Use the default process
+# pool for parallel detection.
+WORKER_POOL = os.getenv("WORKER_POOL", "process")
+# Workers in this process get the reference encodings directly, only a
+# process pool needs them in shared memory
+IN_PROCESS_WORKERS = USE_GPU or WORKER_POOL == "thread"
+def make_executor():
+    if USE_GPU:
+        return ThreadPoolExecutor(max_workers=os.cpu_count())
+    if WORKER_POOL == "thread":
+        return ThreadPoolExecutor(max_workers=os.cpu_count(), initializer=_worker_init)
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_worker_init)
+
+EXECUTOR = make_executor()
+EXECUTOR_LOCK = threading.Lock()
+
+# Shared memory segments this worker has attached to, keyed by name
+_attached_refs = {}
+
+def share_ref_encodings(ref_enc):
+    # Publish the reference encodings once per request; tasks only carry the
+    # small handle returned here instead of a pickled copy of the array.
+    if IN_PROCESS_WORKERS:
+        return None, ref_enc
+    ref_q, ref_sq, scale = ref_enc
+    shm = shared_memory.SharedMemory(create=True, size=ref_q.nbytes)
+    np.ndarray(ref_q.shape, dtype=ref_q.dtype, buffer=shm.buf)[:] = ref_q
+    return shm, (shm.name, ref_q.shape, ref_sq, scale)
+
+def attach_ref_encodings(ref_handle):
+    if IN_PROCESS_WORKERS:
+        return ref_handle
+    name, shape, ref_sq, scale = ref_handle
+    if name not in _attached_refs:
+        if len(_attached_refs) > 8:
+            _attached_refs.pop(next(iter(_attached_refs))).close()
+        _attached_refs[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.int8, buffer=_attached_refs[name].buf), ref_sq, scale
+
+def release_ref_encodings(shm):
+    if shm is None:
+        return
+    shm.close()
+    shm.unlink()
+
+def make_staging_dir():
+    return tempfile.mkdtemp(prefix="veri-", dir=STAGING_ROOT)
+
+def cached_encodings(enc_key):
+    # A cache that can't be read (lock timeout, corrupt entry) is a miss
+    try:
+        return enc_cache.get(enc_key)
+    except Exception as e:
+        print(f"Encoding cache error: {e}")
+        return None
+
+def store_encodings(enc_key, encs):
+    # Only called with encodings from a successful detection
+    try:
+        enc_cache.set(enc_key, encs)
+    except Exception as e:
+        print(f"Encoding cache error: {e}")
+
+def is_match(encs, ref_enc):
+    ref_q, ref_sq, scale = ref_enc
+    enc_q = quantize_encodings(np.asarray(encs, dtype=np.float32).reshape(-1, 128), scale)
+    return bool(any_match(enc_q, ref_q, ref_sq, (MATCH_TOLERANCE * scale) ** 2))
+
 def match_one_image(args):
-    img_data, file_name, ref_enc = args
+    img_path, file_name, ref_handle, enc_key = args
     try:
-        img = load_image_any_format(img_data)
-        encs = extract_face_encodings(img)
-        for test_enc in encs:
-            distances = face_recognition.face_distance(ref_enc, test_enc)
-            if any(d < 0.6 for d in distances):
-                return ('matched', file_name, img_data)
+        encs = cached_encodings(enc_key) if enc_key else None
+        if encs is None:
+            img = load_image_any_format(img_path, max_size=MAX_DETECTION_SIZE)
+            if img is None:
+                return ('failed', file_name, None)
+            encs = np.asarray(detect_face_encodings(img), dtype=np.float32).reshape(-1, 128)
+            if enc_key:
+                store_encodings(enc_key, encs)
+        if len(encs) == 0:
+            return ('unmatched', file_name, None)
+        if is_match(encs, attach_ref_encodings(ref_handle)):
+            return ('matched', file_name, img_path)
         return ('unmatched', file_name, None)
     except Exception as e:
         print(f"Error: {e}")
-        return ('unmatched', file_name, None)
+        return ('failed', file_name, None)
+
+gpu_jobs = queue.Queue()
+
+def submit_match(task):
+    # Same contract as EXECUTOR.submit(match_one_image, task) on every backend
+    if USE_GPU:
+        future = Future()
+        gpu_jobs.put((task, future))
+        return future
+    global EXECUTOR
+    executor = EXECUTOR
+    try:
+        return executor.submit(match_one_image, task)
+    except BrokenProcessPool:
+        # A worker died (OOM, a dlib crash on a bad photo) and took the pool
+        # with it; replace it once so later tasks and requests still run.
+        with EXECUTOR_LOCK:
+            if EXECUTOR is executor:
+                print("⚠️ Worker pool broke, starting a new one")
+                EXECUTOR = make_executor()
+                executor.shutdown(wait=False)
+            executor = EXECUTOR
+        return executor.submit(match_one_image, task)
+
+def match_gpu_batch(jobs):
+    tasks = [task for task, _ in jobs]
+    encodings = [cached_encodings(enc_key) if enc_key else None for _, _, _, enc_key in tasks]
+    pending = [i for i, encs in enumerate(encodings) if encs is None]
+    images = EXECUTOR.map(lambda i: load_image_any_format(tasks[i][0], max_size=MAX_DETECTION_SIZE), pending)
+
+    # The CNN detector only batches images of equal size, so group by shape
+    # Images that fail to decode keep None and are reported as failed
+    by_shape = {}
+    for i, img in zip(pending, images):
+        if img is not None:
+            by_shape.setdefault(img.shape, []).append((i, img))
+    while by_shape:
+        # Pop each group so its decoded images are freed once encoded
+        _, group = by_shape.popitem()
+        batch = [img for _, img in group]
+        with _dlib_lock:
+            batch_locations = face_recognition.batch_face_locations(batch, number_of_times_to_upsample=0, batch_size=BATCH_SIZE)
+        for (i, img), locations in zip(group, batch_locations):
+            with _dlib_lock:
+                encs = face_recognition.face_encodings(img, locations) if locations else []
+            encodings[i] = np.asarray(encs, dtype=np.float32).reshape(-1, 128)
+            if tasks[i][3]:
+                store_encodings(tasks[i][3], encodings[i])
+
+    for (task, future), encs in zip(jobs, encodings):
+        img_path, file_name, ref_handle, _ = task
+        if encs is None:
+            future.set_result(('failed', file_name, None))
+        elif len(encs) and is_match(encs, attach_ref_encodings(ref_handle)):
+            future.set_result(('matched', file_name, img_path))
+        else:
+            future.set_result(('unmatched', file_name, None))
+
+def gpu_batch_loop():
+    while True:
+        jobs = [gpu_jobs.get()]
+        while len(jobs) < BATCH_SIZE:
+            try:
+                jobs.append(gpu_jobs.get(timeout=GPU_BATCH_WAIT))
+            except queue.Empty:
+                break
+        try:
+            match_gpu_batch(jobs)
+        except Exception as e:
+            print(f"Error: {e}")
+            for (_, file_name, _, _), future in jobs:
+                if not future.done():
+                    future.set_result(('failed', file_name, None))
 
-# === NEW: MongoDB handling functions ===
+if USE_GPU:
+    threading.Thread(target=gpu_batch_loop, daemon=True).start()
 
-def save_reference_image_to_mongodb(session_id, image_bytes, filename):
-    # Remove any previous image for this session
-    for file_obj in fs.find({"session_id": session_id}):
-        fs.delete(file_obj._id)    
-    fs.put(image_bytes, filename=filename, session_id=session_id)
-    return True
+# === NEW: MongoDB handling functions ===
 
-def get_reference_image_from_mongodb(session_id):
-    file_obj = fs.find_one({"session_id": session_id})
-    if file_obj:
-        return file_obj.read()
-    else:
+def build_ref_encodings(ref_arr):
+    # Quantized form used by is_match, see quantize_encodings
+    if len(ref_arr) == 0:
         return None
+    ref_arr = np.ascontiguousarray(ref_arr, dtype=np.float32)
+    # Leave 2x headroom over the reference range so probe values are
+    # rarely clipped when quantized with the same scale.
+    scale = 127 / (2 * float(np.abs(ref_arr).max()))
+    ref_q = quantize_encodings(ref_arr, scale)
+    return (ref_q, squared_norms(ref_q), scale)
+
+def cache_ref_encodings(session_id, ref_enc):
+    if len(ref_encodings_cache) > 100:
+        ref_encodings_cache.pop(next(iter(ref_encodings_cache)))
+    ref_encodings_cache[session_id] = ref_enc
+
+def save_reference_encodings_to_mongodb(session_id, image_bytes, filename):
+    # Only the encodings are kept, the image itself is never needed again.
+    # A faceless reference is stored as an empty matrix.
+    img_arr = load_image_any_format(image_bytes)
+    enc = extract_face_encodings(img_arr) if img_arr is not None else []
+    ref_arr = np.asarray(enc, dtype=np.float32).reshape(-1, 128)
+    ref_encs.replace_one(
+        {"session_id": session_id},
+        {"session_id": session_id, "filename": filename,
+         "enc_bytes": Binary(ref_arr.tobytes()), "shape": list(ref_arr.shape)},
+        upsert=True,
+    )
+    cache_ref_encodings(session_id, build_ref_encodings(ref_arr))
+    return True
 
 # =========== MODIFY get_ref_encodings ========================
 def get_ref_encodings(session_id, _reference_path_ignored=None):
     if session_id in ref_encodings_cache:
         return ref_encodings_cache[session_id]
-    # Load image from MongoDB
-    img_bytes = get_reference_image_from_mongodb(session_id)
-    if img_bytes is None:
-        return []
-    img_arr = load_image_any_format(img_bytes)
-    if img_arr is not None:
-        enc = extract_face_encodings(img_arr)
-        if enc:
-            if len(ref_encodings_cache) > 100:
-                ref_encodings_cache.pop(next(iter(ref_encodings_cache)))
-            ref_encodings_cache[session_id] = enc
-            return enc
-    return []
+    doc = ref_encs.find_one({"session_id": session_id})
+    if doc is None:
+        return None
+    ref_arr = np.frombuffer(doc["enc_bytes"], dtype=np.float32).reshape(doc["shape"])
+    ref_enc = build_ref_encodings(ref_arr)
+    cache_ref_encodings(session_id, ref_enc)
+    return ref_enc
 
 # =============================================================
 
+def finish_match(future, file_name, img_path):
+    try:
+        result = future.result()
+    except Exception as e:
+        print(f"Error: {e}")
+        result = ('failed', file_name, None)
+    if result[0] != 'matched':
+        try:
+            os.remove(img_path)
+        except OSError as e:
+            print(f"Staging cleanup error: {e}")
+    return result
+
+def stream_matches(results, session_id, total_count):
+    # Yields ('matched', file_name, img_data) and ('failed', file_name, None)
+    # for photos that could not be staged or processed.
+    completed = 0
+    for kind, fname, img_path in results:
+        completed += 1
+        report_progress(session_id, completed, total_count)
+        if kind == 'matched':
+            with open(img_path, 'rb') as f:
+                img_data = f.read()
+            os.remove(img_path)
+            yield kind, fname, img_data
+        elif kind == 'failed':
+            yield kind, fname, None
+
 def compare_faces(reference_path, drive_files, session_id):
-    matched, unmatched = [], []
+    # Generator over stream_matches results for a Drive folder, each yielded
+    # as soon as it is in.
     ref_enc = get_ref_encodings(session_id)
-    if not ref_enc:
-        return matched, unmatched
+    if ref_enc is None:
+        return
 
-    service = get_drive_service()
     total_count = len(drive_files)
-    update_firebase_progress(session_id, 0, total_count)
+    report_progress(session_id, 0, total_count)
 
-    tasks = []
-    for file in drive_files:
+    shm, ref_handle = share_ref_encodings(ref_enc)
+    staging_dir = make_staging_dir()
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(MAX_INFLIGHT_IMAGES)
+    cancelled = threading.Event()
+
+    def fetch_and_match(idx, file):
+        # Must put exactly one result for the file, drain() waits for it
+        img_path = os.path.join(staging_dir, f"{idx}.bin")
         try:
-            request = service.files().get_media(fileId=file['id'])
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            fh.seek(0)
-            img_data = fh.read()
-            tasks.append((img_data, file['name'], ref_enc))
+            if cancelled.is_set():
+                results.put(('failed', file['name'], None))
+                return
+            # A known non-match doesn't need to be downloaded at all
+            cached = cached_encodings(encoding_cache_key(file))
+            if cached is not None and not (len(cached) and is_match(cached, ref_enc)):
+                results.put(('unmatched', file['name'], None))
+                return
+            download_drive_file(file['id'], img_path)
+            future = submit_match((img_path, file['name'], ref_handle, encoding_cache_key(file)))
         except Exception as e:
             print(f"Download error: {e}")
-            unmatched.append(file['name'])
-
-    completed = 0
-    with ProcessPoolExecutor() as executor:
-        for i in range(0, len(tasks), BATCH_SIZE):
-            batch = tasks[i:i + BATCH_SIZE]
-            results = list(executor.map(match_one_image, batch))
-            for result in results:
-                kind, fname, imgdata = result
-                if kind == 'matched':
-                    matched.append((fname, imgdata))
-                else:
-                    unmatched.append(fname)
-                completed += 1
-                update_firebase_progress(session_id, completed, total_count)
-    return matched, unmatched
+            results.put(('failed', file['name'], None))
+            return
+        future.add_done_callback(lambda f: results.put(finish_match(f, file['name'], img_path)))
+
+    def dispatch():
+        # Keep downloads running while the pool works on earlier images; a
+        # slot is only freed once its result has been consumed below.
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as downloads:
+            for idx, file in enumerate(drive_files):
+                while not slots.acquire(timeout=1):
+                    if cancelled.is_set():
+                        return
+                if cancelled.is_set():
+                    return
+                downloads.submit(fetch_and_match, idx, file)
+
+    def drain():
+        for _ in range(total_count):
+            yield results.get()
+            slots.release()
+
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+    try:
+        yield from stream_matches(drain(), session_id, total_count)
+        dispatcher.join()
+    finally:
+        # Also reached when the client goes away mid-stream
+        cancelled.set()
+        release_ref_encodings(shm)
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 def compare_faces_local(reference_path, uploaded_files, session_id):
-    matched, unmatched = [], []
+    # Generator over stream_matches results for uploaded files. Uploads are
+    # staged before the first yield, while the request is still open.
     ref_enc = get_ref_encodings(session_id)
-    if not ref_enc:
-        return matched, unmatched
+    if ref_enc is None:
+        return
 
     total_count = len(uploaded_files)
-    update_firebase_progress(session_id, 0, total_count)
-    tasks = []
+    report_progress(session_id, 0, total_count)
+
+    shm, ref_handle = share_ref_encodings(ref_enc)
+    staging_dir = make_staging_dir()
+    try:
+        tasks, failed = [], []
+        for idx, file in enumerate(uploaded_files):
+            try:
+                img_path = os.path.join(staging_dir, f"{idx}.bin")
+                file.save(img_path)
+                tasks.append((img_path, file.filename, ref_handle, None))
+            except Exception as e:
+                print(f"Read error: {e}")
+                failed.append(('failed', file.filename, None))
+
+        futures = [submit_match(task) for task in tasks]
+        results = (finish_match(future, task[1], task[0]) for task, future in zip(tasks, futures))
+        yield from stream_matches(itertools.chain(failed, results), session_id, total_count)
+    finally:
+        release_ref_encodings(shm)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+class ZipChunkWriter(io.RawIOBase):
+    # Write-only, unseekable sink that hands zipfile output back in chunks
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+class ResultSpool:
+    # Result zip of one submission, written to a temp file by a single
+    # builder thread and tailed by the response of every request for that
+    # submission. state goes "pending" -> "building" -> "zip" (complete and
+    # cached) or "partial" (complete, lists failures); "no_match" or "failed"
+    # can end it at any point.
+    FINAL_STATES = ("zip", "partial", "no_match", "failed")
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="veri-", suffix=".zip")
+        os.close(fd)
+        self.size = 0
+        self.state = "pending"
+        self.cond = threading.Condition()
+
+    def set_state(self, state):
+        with self.cond:
+            self.state = state
+            self.cond.notify_all()
+
+    def wait_started(self):
+        # The leader always settles the spool (see finish_flight), so this
+        # returns once it found a first match, found none or failed
+        with self.cond:
+            self.cond.wait_for(lambda: self.state != "pending")
+            return self.state
+
+    def append(self, out, data):
+        out.write(data)
+        out.flush()
+        with self.cond:
+            self.size += len(data)
+            self.cond.notify_all()
+
+    def open_reader(self):
+        return open(self.path, 'rb')
+
+    def stream(self, reader):
+        with reader:
+            offset = 0
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.size > offset or self.state in self.FINAL_STATES)
+                    size = self.size
+                    finished = self.state in self.FINAL_STATES
+                if size > offset:
+                    data = reader.read(size - offset)
+                    offset += len(data)
+                    yield data
+                elif finished:
+                    return
+
+# Submissions currently being processed, keyed by result_cache_key
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+def join_flight(cache_key):
+    # Returns (spool, reader, is_leader); only the leader runs the pipeline.
+    # The reader is opened under the lock, before finish_flight can remove
+    # the spool file.
+    with INFLIGHT_LOCK:
+        spool = INFLIGHT.get(cache_key)
+        is_leader = spool is None
+        if is_leader:
+            spool = INFLIGHT[cache_key] = ResultSpool()
+        return spool, spool.open_reader(), is_leader
+
+def finish_flight(cache_key, spool, outcome):
+    with INFLIGHT_LOCK:
+        if INFLIGHT.get(cache_key) is spool:
+            del INFLIGHT[cache_key]
+    spool.set_state(outcome)
+    # Open readers keep the data until they are done
+    os.remove(spool.path)
+
+def result_cache_key(ref_img_bytes, source_ids):
+    digest = hashlib.sha1(ref_img_bytes)
+    digest.update(b'|' + ','.join(sorted(source_ids)).encode())
+    return digest.hexdigest()
+
+def local_source_ids(uploaded_files):
+    # Uploads have no stable id, identify them by name and content
+    source_ids = []
     for file in uploaded_files:
-        try:
-            img_data = file.read()
-            tasks.append((img_data, file.filename, ref_enc))
-        except Exception as e:
-            print(f"Read error: {e}")
-            unmatched.append(file.filename)
-    completed = 0
-    with ProcessPoolExecutor() as executor:
-        for i in range(0, len(tasks), BATCH_SIZE):
-            batch = tasks[i:i + BATCH_SIZE]
-            results = list(executor.map(match_one_image, batch))
-            for result in results:
-                kind, fname, imgdata = result
-                if kind == 'matched':
-                    matched.append((fname, imgdata))
-                else:
-                    unmatched.append(fname)
-                completed += 1
-                update_firebase_progress(session_id, completed, total_count)
-    return matched, unmatched
+        source_ids.append(f"{file.filename}:{hashlib.sha1(file.read()).hexdigest()}")
+        file.seek(0)
+    return source_ids
+
+def prepend_match(first_match, matches):
+    # Like itertools.chain([first_match], matches), but lets go of the first
+    # photo as soon as the next match is requested, and closes matches.
+    try:
+        yield first_match
+        del first_match
+        yield from matches
+    finally:
+        matches.close()
+
+def build_result_zip(spool, matches, session_id, cache_key):
+    # Runs on its own thread so the zip is completed and cached even if the
+    # client that started it goes away. Entries are appended to the spool as
+    # matches arrive, so only one photo is held in memory and downloads start
+    # before matching has finished. Photos are already compressed, so entries
+    # are stored rather than deflated. Photos that could not be processed are
+    # listed in FAILED_LIST_NAME, and such an incomplete result isn't cached.
+    sink = ZipChunkWriter()
+    failed = []
+    outcome = "failed"
+    try:
+        spool.set_state("building")
+        with open(spool.path, 'wb') as out:
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zipf:
+                for kind, fname, img_data in matches:
+                    if kind == 'failed':
+                        failed.append(fname)
+                        continue
+                    clean_name = os.path.basename(fname)
+                    zipf.writestr(clean_name, img_data)
+                    del img_data
+                    spool.append(out, sink.drain())
+                if failed:
+                    zipf.writestr(FAILED_LIST_NAME, "\n".join(failed) + "\n")
+            spool.append(out, sink.drain())
+        if failed:
+            outcome = "partial"
+        else:
+            with open(spool.path, 'rb') as f:
+                zip_cache.set(cache_key, f, read=True, expire=ZIP_CACHE_TTL)
+            outcome = "zip"
+    except Exception as e:
+        print(f"Zip build error: {e}")
+    finally:
+        matches.close()
+        ref_encs.delete_one({"session_id": session_id})
+        finish_flight(cache_key, spool, outcome)
+
+def zip_response(body):
+    return Response(body, mimetype='application/zip',
+                    headers={"Content-Disposition": "attachment; filename=matched_photos.zip"})
+
+def render_no_match():
+    return render_template("index.html",
+            firebase_config=firebase_config,
+            session_id="error",
+            matched=[],
+            unmatched=[],
+            error="No face detected in the reference image.")
 
 @app.route("/progress/<session_id>")
 def progress(session_id):
@@ -249,7 +839,6 @@ def index():
         session_id = request.form.get("session_id") 
     else:
         session_id = generate_session_id()    
-    matched, unmatched = [], []
     filepath = None
     progress_data = {"session_id":session_id,"current": 0, "total": 0}
     update_firebase_progress(session_id,0, 0)
@@ -274,32 +863,56 @@ def index():
             except Exception as e:
                 print(f"Webcam decode error: {e}")
 
-        # Save reference image to MongoDB instead of filesystem
+        # Save reference encodings to MongoDB instead of filesystem
         if ref_img_bytes:
-            save_reference_image_to_mongodb(session_id, ref_img_bytes, ref_img_filename)
-
+            drive_files = download_drive_images(folder_id) if folder_id else []
             if folder_id:
-                drive_files = download_drive_images(folder_id)
-                matched, unmatched = compare_faces(None, drive_files, session_id)
-            elif local_files:
-                matched, unmatched = compare_faces_local(None, local_files, session_id)
-
-            if len(matched) == 0:
-                return render_template("index.html",
-                        firebase_config=firebase_config,
-                        session_id="error",
-                        matched=[],
-                        unmatched=[],
-                        error="No face detected in the reference image.") 
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for fname, img_data in matched:
-                    clean_name = os.path.basename(fname)
-                    zipf.writestr(clean_name, img_data)
-            zip_buffer.seek(0)
-            for file_obj in fs.find({"session_id": session_id}):
-                fs.delete(file_obj._id)
-            return send_file(zip_buffer, mimetype='application/zip', as_attachment=True, download_name='matched_photos.zip')
+                source_ids = [encoding_cache_key(file) for file in drive_files]
+            else:
+                source_ids = local_source_ids(local_files)
+            cache_key = result_cache_key(ref_img_bytes, source_ids)
+            while True:
+                # A file handle, so the cached zip is streamed from disk
+                cached_zip = zip_cache.get(cache_key, read=True)
+                if cached_zip is not None:
+                    return send_file(cached_zip, mimetype='application/zip', as_attachment=True,
+                                     download_name='matched_photos.zip', conditional=True, etag=cache_key)
+                spool, reader, is_leader = join_flight(cache_key)
+                if is_leader:
+                    break
+                # The same submission is already running (e.g. a double
+                # click), share its zip instead of running the pipeline twice
+                state = spool.wait_started()
+                if state == "no_match":
+                    reader.close()
+                    return render_no_match()
+                if state != "failed":
+                    return zip_response(spool.stream(reader))
+                reader.close()
+                # The first run failed, try again (likely as the leader)
+
+            try:
+                save_reference_encodings_to_mongodb(session_id, ref_img_bytes, ref_img_filename)
+                del ref_img_bytes  # Only the encodings are needed from here on
+
+                matches = iter(())
+                if folder_id:
+                    matches = compare_faces(None, drive_files, session_id)
+                elif local_files:
+                    matches = compare_faces_local(None, local_files, session_id)
+
+                first_match = next(matches, None)
+            except BaseException:
+                reader.close()
+                finish_flight(cache_key, spool, "failed")
+                raise
+            if first_match is None:
+                reader.close()
+                finish_flight(cache_key, spool, "no_match")
+                return render_no_match()
+            threading.Thread(target=build_result_zip, daemon=True,
+                             args=(spool, prepend_match(first_match, matches), session_id, cache_key)).start()
+            return zip_response(spool.stream(reader))
     return render_template("index.html", firebase_config=firebase_config, session_id=session_id, matched=[], unmatched=[])
 
 @app.route("/clean-expired", methods=["POST"])
@@ -315,10 +928,8 @@ def clean_expired_sessions():
             expires_at = entry.get("expiresAt")
             if expires_at and expires_at < now:
                 db.reference(f"face_match_progress/{session_id}").delete()
-                # Also clean up reference images from MongoDB
-                file_obj = fs.find_one({"session_id": session_id})
-                if file_obj:
-                    fs.delete(file_obj._id)
+                # Also clean up reference encodings from MongoDB
+                ref_encs.delete_one({"session_id": session_id})
                 print(f"✅ Deleted expired session: {session_id}")
                 deleted += 1
         return jsonify({